@@ -1,21 +1,20 @@
 import os, warnings, dataclasses, collections, itertools, time, functools, typing
 import pandas as pd, numpy as np, scipy.sparse as sps
 from pytorch_lightning.loggers import TensorBoardLogger
-from ccrec.util import merge_unique
+from ccrec.util import merge_unique_batch
 from rime.dataset import Dataset
 from rime.util import indices2csr, perplexity, matrix_reindex
 
 
 def create_zero_shot(item_df, self_training=False):
     user_df = pd.DataFrame({"TEST_START_TIME": [1] * len(item_df)})  # naturally indexed
+    n_copies = 2 if self_training else 1  # self_training repeats each event at TIMESTAMP=1
     event_df = pd.DataFrame({
-        'USER_ID': np.arange(len(item_df)),
-        'ITEM_ID': item_df.index.values,
-        'TIMESTAMP': 0,
+        'USER_ID': np.tile(np.arange(len(item_df)), n_copies),
+        'ITEM_ID': np.tile(item_df.index.values, n_copies),
+        'TIMESTAMP': np.repeat(np.arange(n_copies), len(item_df)),
         'VALUE': 1,
     })
-    if self_training:
-        event_df = pd.concat([event_df, event_df.assign(TIMESTAMP=1)], ignore_index=True)
     return Dataset(user_df, item_df, event_df)
 
 
@@ -23,24 +22,25 @@ def _sanitize_inputs(event_df, user_df, item_df, clear_future_events=None):
     assert user_df.index.is_unique, "require unique user ids"
     if event_df is None:
         user_non_empty = user_df[user_df['_hist_len'] > 0]
-        event_df = user_non_empty['_hist_items'].explode().to_frame("ITEM_ID").assign(
-            TIMESTAMP=user_non_empty['_hist_ts'].explode().values,
-            VALUE=user_non_empty['_hist_values'].explode().values,
-            USER_ID=lambda x: x.index.get_level_values(0),
-        )[['USER_ID', 'ITEM_ID', 'TIMESTAMP', 'VALUE']].reset_index(drop=True)
+        event_df = pd.DataFrame({
+            'USER_ID': np.repeat(user_non_empty.index.get_level_values(0).values, user_non_empty['_hist_len'].values),
+            'ITEM_ID': np.concatenate(user_non_empty['_hist_items'].values),
+            'TIMESTAMP': np.concatenate(user_non_empty['_hist_ts'].values),
+            'VALUE': np.concatenate(user_non_empty['_hist_values'].values),
+        })
 
     assert event_df['TIMESTAMP'].max() < time.time(), "require TIMESTAMP < current request_time"
     if 'VALUE' not in event_df:
         event_df = event_df.assign(VALUE=1)
 
-    event_old, event_df = event_df, event_df[event_df['USER_ID'].isin(user_df.index) &
-                                             event_df['ITEM_ID'].isin(item_df.index)].copy()
+    user_codes = user_df.index.get_indexer(event_df['USER_ID'])  # -1 if unknown; user ids are unique
+    known_items = event_df['ITEM_ID'].isin(item_df.index).values  # item_df may repeat ids
+    event_old, event_df = event_df, event_df[(user_codes >= 0) & known_items].copy()
     if len(event_old) > len(event_df):
         print(f"filtering events by known USER_ID and ITEM_ID. #events {len(event_old)} -> {len(event_df)}")
 
-    past_event_df = event_df.join(
-        user_df.groupby(level=0).first()[['TEST_START_TIME']], on='USER_ID'
-    ).query("TIMESTAMP < TEST_START_TIME").drop("TEST_START_TIME", axis=1)
+    test_start_time = user_df.groupby(level=0)['TEST_START_TIME'].first()
+    past_event_df = event_df[event_df['TIMESTAMP'].values < event_df['USER_ID'].map(test_start_time).values]
 
     if len(past_event_df) < len(event_df):
         if clear_future_events is None:
@@ -107,9 +107,14 @@ class Env:
     def _item_titles(self):
         item_df = self.item_df if 'TITLE' in self.item_df else \
                   self.item_df.assign(TITLE=self.item_df.index.astype(str))
-        return item_df['TITLE'].apply(
-            lambda x: x if len(x) < self._text_width else
-            x[:self._text_width - 4 * self._text_ellipsis] + ' ...' * self._text_ellipsis)
+        titles = item_df['TITLE'].astype(str)
+        truncated = titles.str.slice(0, self._text_width - 4 * self._text_ellipsis) + ' ...' * self._text_ellipsis
+        return titles.where(titles.str.len() < self._text_width, truncated)
+
+    @functools.cached_property
+    def _item_title_map(self):
+        """ plain dict to avoid pandas indexing overhead per lookup; item_df is fixed after init """
+        return self._item_titles.to_dict()
 
     def _get_step_idx(self):
         return self._start_step_idx if len(self._response) == 0 else max(self._response.keys()) + 1
@@ -128,10 +133,12 @@ class Env:
 
         if self.recording:
             self._update_events(response, step_idx)
+        data = np.vstack(response['multi_label'].tolist())
+        group = np.vstack(response['_group'].tolist())
         self._logger.log_metrics({'collected_len': len(response),
-                                  'collected_sum': np.vstack(response['multi_label']).sum()}, step_idx)
+                                  'collected_sum': data.sum()}, step_idx)
 
-        reward_by_policy = _evaluate_response(response)
+        reward_by_policy = _evaluate_response(data, group)
         self._reward_by_policy.append(reward_by_policy)
         self._logger.experiment.add_scalars('reward_by_policy', reward_by_policy, step_idx)
         return reward_by_policy
@@ -147,16 +154,15 @@ class Env:
         total_size = sum(sample_size)
         J = [p(D, total_size) for p in policies]
 
-        rows = zip(*J)
-        display = [merge_unique(lol, sample_size, total_size) for lol in rows]
-        display_J, display_groups = zip(*display)
+        display_J, display_groups = merge_unique_batch(J, sample_size, total_size)
 
         req = D.test_requests[['_hist_items']].assign(
-            cand_items=self.item_in_test.index.values[np.asarray(display_J)].tolist(),
-            _group=np.asarray(display_groups).tolist(),
+            cand_items=self.item_in_test.index.values[display_J].tolist(),
+            _group=display_groups.tolist(),
             request_time=time.time())
-        req['last_title'] = req['_hist_items'].apply(lambda x: self._item_titles.loc[x[-1]] if len(x) else '(empty)')
-        req['cand_titles'] = req['cand_items'].apply(lambda x: self._item_titles.loc[x].tolist())
+        title_map = self._item_title_map
+        req['last_title'] = [title_map[x[-1]] if len(x) else '(empty)' for x in req['_hist_items']]
+        req['cand_titles'] = [[title_map[y] for y in x] for x in req['cand_items']]
         req = _sort_or_shuffle(req, self._sort_candidates)
         return req, D  # for SimuEnv
 
@@ -165,6 +171,7 @@ class Env:
 
     def _update_events(self, response, step_idx):
         new_events = parse_response(response, step_idx)
+        # concat eagerly; every step reads the full event_df in _create_request, so lazy buffering saves no copies
         self.event_df = pd.concat([self.event_df, new_events], ignore_index=True)
 
     def _create_testing_dataset(self, test_requests=None):
@@ -175,8 +182,9 @@ class Env:
                        sample_with_prior=self.sample_with_prior)
 
     def _create_training_dataset(self, before_step_idx=float('inf'), test_update_history=False):
-        test_requests = self.event_df.query(f"0 <= step_idx < {before_step_idx}").groupby(
-            ['USER_ID', 'TIMESTAMP']).size().to_frame('_siz')
+        step_idx = self.event_df['step_idx'].values
+        test_requests = self.event_df[(step_idx >= 0) & (step_idx < before_step_idx)].groupby(
+            ['USER_ID', 'TIMESTAMP'], sort=False).size().to_frame('_siz')
         return Dataset(self.user_df, self.item_df, self.event_df,
                        test_requests, self.item_in_test,
                        exclude_train=self.exclude_train,
@@ -187,35 +195,37 @@ class Env:
 
 def query_least_certain_users(batch_size):
     def fn(user_df, event_df):
-        user_context = event_df.join(user_df, on='USER_ID').query('TIMESTAMP < TEST_START_TIME') \
-                    .groupby('USER_ID')['ITEM_ID'].first()
+        is_past = event_df['TIMESTAMP'].values < event_df['USER_ID'].map(user_df['TEST_START_TIME']).values
+        user_context = event_df[is_past].drop_duplicates('USER_ID').set_index('USER_ID')['ITEM_ID']
 
-        least_certain_users = event_df.join(user_context.to_frame('given'), on='USER_ID').query('given != ITEM_ID') \
-                                      .groupby('USER_ID')['VALUE'].sum().reindex(user_df.index, fill_value=0) \
-                                      .sort_values().iloc[:batch_size]
+        not_given = event_df['USER_ID'].map(user_context).values != event_df['ITEM_ID'].values
+        least_certain_users = event_df[not_given].groupby('USER_ID', sort=False)['VALUE'].sum() \
+                                                 .reindex(user_df.index, fill_value=0) \
+                                                 .sort_values().iloc[:batch_size]
 
         return least_certain_users.to_frame('_value_sum').join(user_df).set_index('TEST_START_TIME', append=True)
     return fn
 
 
 def _sort_or_shuffle(request, _sort_candidates):
-    request = request.assign(
-        _reverse_index=request['_group'].apply(
-            lambda x: np.argsort(np.asarray(x)[np.asarray(x) != -1], kind='stable')
-            if _sort_candidates else np.random.permutation(len(x))
-        ))
+    """ permute all rows at once; assumes equal-length candidates, i.e., fixed total_size """
+    group = np.asarray(request['_group'].tolist())
+    if _sort_candidates:  # invalid groups (-1) go last
+        perm = np.argsort(np.where(group == -1, np.iinfo(group.dtype).max, group), axis=1, kind='stable')
+    else:
+        perm = np.argsort(np.random.random(group.shape), axis=1)
+    _take = lambda col: np.take_along_axis(
+        np.asarray(request[col].tolist(), dtype=object), perm, 1).tolist()
     return request.assign(
-        _group=lambda df: df.apply(
-            lambda x: np.asarray(x['_group'])[x['_reverse_index']].tolist(), axis=1),
-        cand_items=lambda df: df.apply(
-            lambda x: np.asarray(x['cand_items'])[x['_reverse_index']].tolist(), axis=1),
-        cand_titles=lambda df: df.apply(
-            lambda x: np.asarray(x['cand_titles'])[x['_reverse_index']].tolist(), axis=1),
-    ).drop('_reverse_index', axis=1)
+        _group=np.take_along_axis(group, perm, 1).tolist(),
+        cand_items=_take('cand_items'),
+        cand_titles=_take('cand_titles'),
+    )
 
 
 def _get_request_perplexity(request):
-    ind, cnt = np.unique(np.hstack(request['cand_items']), return_counts=True)
+    cand_items = itertools.chain.from_iterable(request['cand_items'])
+    cnt = pd.Series(list(cand_items)).value_counts(sort=False).values  # hash counts, no sorting
     return perplexity(cnt)
 
 
@@ -228,27 +238,24 @@ def _expand_na_class(request):
 def parse_response(response, step_idx=None, infer_time_unit=True):
     if step_idx is None:
         step_idx = response['request_time'].rank(method='dense').values - 1
-    response = response.assign(step_idx=step_idx).set_index("step_idx", append=True)
-
-    new_events = response['cand_items'].explode().to_frame("ITEM_ID")
-    new_events['USER_ID'] = new_events.index.get_level_values(0)
-    new_events['TIMESTAMP'] = response['request_time']  # reindex to explode
-    new_events['VALUE'] = response['multi_label'].explode().values
-    new_events['_group'] = response['_group'].explode().values
-    new_events['step_idx'] = new_events.index.get_level_values(-1)
+    lens = response['cand_items'].str.len().values  # flatten all list columns in one pass
+    new_events = pd.DataFrame({
+        'ITEM_ID': np.concatenate(response['cand_items'].values),
+        'USER_ID': np.repeat(response.index.get_level_values(0).values, lens),
+        'TIMESTAMP': np.repeat(response['request_time'].values, lens),
+        'VALUE': np.concatenate(response['multi_label'].values),
+        '_group': np.concatenate(response['_group'].values),
+        'step_idx': np.repeat(np.broadcast_to(step_idx, len(response)), lens),
+    })
 
     if infer_time_unit and new_events['TIMESTAMP'].max() > time.time():
         new_events['TIMESTAMP'] = new_events['TIMESTAMP'] / 1e3
-    return new_events.reset_index(drop=True)
-
+    return new_events
 
-def _evaluate_response(response):
-    data = np.vstack(response['multi_label'])
-    group = np.vstack(response['_group'])
 
-    out = {}
-    for group_id in np.unique(group):
-        pos = data[group == group_id].sum()
-        imp = (group == group_id).sum()
-        out[str(group_id)] = pos / imp
-    return out
+def _evaluate_response(data, group):
+    """ data and group are the stacked multi_label and _group columns of the response """
+    group = group.ravel() + 1  # shift the n/a class (-1) for bincount
+    pos = np.bincount(group, weights=data.ravel().astype(np.float64))
+    imp = np.bincount(group)
+    return {str(g - 1): pos[g] / imp[g] for g in np.flatnonzero(imp)}
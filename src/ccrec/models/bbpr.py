@@ -9,7 +9,7 @@ from pytorch_lightning.callbacks import LearningRateMonitor
 from pytorch_lightning.loggers import TensorBoardLogger
 import functools, torch, numpy as np, pandas as pd
 import os, itertools, dataclasses, warnings, collections, re, tqdm
-from ccrec.util import _device_mode_context
+from ccrec.util import _device_mode_context, bf16_autocast_enabled, quantize_linear_int8
 from ccrec.util.shap_explainer import I2IExplainer
 
 # https://pytorch-lightning.readthedocs.io/en/stable/notebooks/lightning_examples/text-transformers.html
@@ -32,6 +32,13 @@ def _create_bert(model_name, freeze_bert):
     return model
 
 
+def _sample_from_cdf(cdf, num_samples):
+    """ same as torch.multinomial(probs, num_samples, replacement=True) given cdf = probs.cumsum(-1),
+    but without per-call sampler setup; batched over the leading dimensions of cdf """
+    u = torch.rand((*cdf.shape[:-1], num_samples), dtype=cdf.dtype, device=cdf.device) * cdf[..., -1:]
+    return torch.searchsorted(cdf, u, right=True).clamp_max(cdf.shape[-1] - 1)
+
+
 class _Tower(torch.nn.Module):
     """ inputs -> model -> cls -> layer_norm -> final """
     def __init__(self, model, layer_norm):
@@ -45,8 +52,10 @@ class _Tower(torch.nn.Module):
 
     def forward(self, cls=None, input_step='inputs', output_step='final', **inputs):
         if input_step == 'inputs':
-            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
-            cls = self.model(**inputs).last_hidden_state[:, 0]
+            inputs = {k: v.to(self.model.device, non_blocking=True) for k, v in inputs.items()}
+            with torch.autocast('cuda', torch.bfloat16, enabled=bf16_autocast_enabled(self.model.device)):
+                cls = self.model(**inputs).last_hidden_state[:, 0]
+            cls = cls.float()  # keep layer_norm in fp32
         else:  # cls
             cls = cls.to(self.model.device)
 
@@ -57,6 +66,9 @@ class _Tower(torch.nn.Module):
 
 
 class _BertBPR(_LitValidated):
+    all_inputs_gpu_bytes = 2 ** 30  # keep a device copy of all_inputs if it is smaller than this
+    dense_prior_bytes = 2 ** 28  # keep a dense prior_score per device if it is smaller than this
+
     def __init__(self, all_inputs, model_name='bert-base-uncased', freeze_bert=0,
                  n_negatives=10, valid_n_negatives=None, lr=None, weight_decay=None,
                  training_prior_fcn=lambda x: x,
@@ -91,18 +103,31 @@ class _BertBPR(_LitValidated):
             self.load_state_dict(torch.load(pretrained_checkpoint))
 
     def set_training_data(self, i_to_ptr=None, j_to_ptr=None, prior_score=None, item_freq=None):
+        self._all_inputs_by_device = {}  # shared by dp replicas; filled on first forward per device
         self.register_buffer("i_to_ptr", torch.as_tensor(i_to_ptr), False)
         self.register_buffer("j_to_ptr", torch.as_tensor(j_to_ptr), False)
         if prior_score is not None and self.sample_with_prior:
-            self.register_buffer("tr_prior_score", sps_to_torch(prior_score, 'cpu'), False)
+            if hasattr(prior_score, 'toarray') and \
+                    np.prod(prior_score.shape) * prior_score.dtype.itemsize < self.dense_prior_bytes:
+                # not a buffer, which dp would re-broadcast to every gpu on every forward
+                self._dense_prior_score = torch.as_tensor(prior_score.toarray())
+                self._dense_prior_by_device = {}  # shared by dp replicas; filled on first use per device
+            else:
+                self.register_buffer("tr_prior_score", sps_to_torch(prior_score, 'cpu'), False)
         if item_freq is not None:
             item_proposal = (item_freq + 0.1) ** self.sample_with_posterior
             self.register_buffer("tr_item_proposal", torch.as_tensor(item_proposal), False)
+            self.register_buffer("tr_item_cdf", self.tr_item_proposal.cumsum(0) / self.tr_item_proposal.sum(), False)
 
     def setup(self, stage):  # auto-call in fit loop
         if stage == 'fit':
             print(self._checkpoint.dirpath)
 
+    def on_fit_end(self):
+        super().on_fit_end()
+        getattr(self, '_all_inputs_by_device', {}).clear()  # release device copies of all_inputs
+        getattr(self, '_dense_prior_by_device', {}).clear()
+
     def forward(self, batch):  # tokenized or ptr
         output_step = getattr(self, "override_output_step", "final")
         if isinstance(batch, collections.abc.Mapping):  # tokenized
@@ -110,36 +135,64 @@ class _BertBPR(_LitValidated):
         elif hasattr(self, 'all_cls'):  # ptr
             return self.item_tower(self.all_cls[batch], input_step='cls', output_step=output_step)
         else:  # ptr to all_inputs
-            return self.item_tower(**{k: v[batch] for k, v in self.all_inputs.items()},
+            all_inputs = self._get_all_inputs(batch.device)
+            return self.item_tower(**{k: v[batch] for k, v in all_inputs.items()},
                                    output_step=output_step)
 
+    def _get_all_inputs(self, device):
+        """ upload all_inputs once per device to skip the per-step host-to-device copies """
+        cache = getattr(self, '_all_inputs_by_device', {})
+        if device not in cache:
+            nbytes = sum(v.element_size() * v.numel() for v in self.all_inputs.values())
+            if device.type == 'cuda' and nbytes < self.all_inputs_gpu_bytes:
+                cache[device] = {k: v.to(device) for k, v in self.all_inputs.items()}
+            else:
+                cache[device] = self.all_inputs
+        return cache[device]
+
+    def _get_prior_score(self, i):
+        if hasattr(self, '_dense_prior_by_device'):
+            cache = self._dense_prior_by_device
+            if i.device not in cache:
+                cache[i.device] = self._dense_prior_score.to(i.device)
+            return cache[i.device].index_select(0, i)
+        elif hasattr(self.tr_prior_score, "as_tensor"):
+            return self.tr_prior_score[i.tolist()].as_tensor(i.device)
+        else:
+            return self.tr_prior_score.index_select(0, i).to_dense()
+
     def _pairwise(self, i, j):  # auto-broadcast on first dimension
-        x = self.forward(self.i_to_ptr[i.ravel()]).reshape([*i.shape, -1])
-        y = self.forward(self.j_to_ptr[j.ravel()]).reshape([*j.shape, -1])
+        i_ptr = self.i_to_ptr[i.ravel()]
+        j_ptr = self.j_to_ptr[j.ravel()]
+        ptr, inverse = torch.unique(torch.cat([i_ptr, j_ptr]), return_inverse=True)  # one forward
+        emb = self.forward(ptr)[inverse]
+        x = emb[:len(i_ptr)].reshape([*i.shape, -1])
+        y = emb[len(i_ptr):].reshape([*j.shape, -1])
         return (x * y).sum(-1)
 
     def training_and_validation_step(self, batch, batch_idx):
         i, j, w = batch.T
         i = i.to(int)
         j = j.to(int)
-        pos_score = self._pairwise(i, j)  # bsz
 
         n_negatives = self.n_negatives if self.training else self.valid_n_negatives
         n_shape = (n_negatives, len(batch))
         loglik = []
 
         with torch.no_grad():
-            if hasattr(self, "tr_prior_score"):
-                if hasattr(self.tr_prior_score, "as_tensor"):
-                    prior_score = self.tr_prior_score[i.tolist()].as_tensor(i.device)
+            if hasattr(self, "tr_prior_score") or hasattr(self, "_dense_prior_score"):
+                prior_score = self._get_prior_score(i)
+                probs = (self.training_prior_fcn(prior_score) + self.tr_item_proposal.log()).softmax(1)
+                if self.replacement:
+                    nj = _sample_from_cdf(probs.cumsum(1), n_negatives).T
                 else:
-                    prior_score = self.tr_prior_score.index_select(0, i).to_dense()
-                nj = torch.multinomial(
-                    (self.training_prior_fcn(prior_score) + self.tr_item_proposal.log()).softmax(1),
-                    n_negatives, self.replacement).T
+                    nj = torch.multinomial(probs, n_negatives, self.replacement).T
+            elif self.replacement:
+                nj = _sample_from_cdf(self.tr_item_cdf, np.prod(n_shape)).reshape(n_shape)
             else:
                 nj = torch.multinomial(self.tr_item_proposal, np.prod(n_shape), self.replacement).reshape(n_shape)
-        nj_score = self._pairwise(i, nj)
+        score = self._pairwise(i, torch.cat([j[None], nj]))  # (1 + nsamp) * bsz
+        pos_score, nj_score = score[0], score[1:]
         loglik.append(F.logsigmoid(pos_score - nj_score))  # nsamp * bsz
 
         return (-torch.stack(loglik) * w).sum() / (len(loglik) * n_negatives * w.sum())
@@ -184,7 +237,7 @@ class _DataModule(LightningDataModule):
         if stage == 'fit':
             target_coo = self._D.target_csr.tocoo()
             dataset = np.transpose([target_coo.row, target_coo.col, target_coo.data])
-            self._num_workers = (len(dataset) > 1e4) * 4
+            self._num_workers = 0  # (row, col, data) triples are cheap to batch; workers only add ipc
 
             if self._do_validation:
                 self._train_set, self._valid_set = default_random_split(dataset)
@@ -203,7 +256,14 @@ class _DataModule(LightningDataModule):
         dataset = Dataset.from_dict(self._item_tokenized)
         return DataLoader(dataset, batch_size=self._predict_batch_size,
                           num_workers=(len(dataset) > 1000) * 4,
-                          collate_fn=DefaultDataCollator())
+                          collate_fn=DefaultDataCollator(), pin_memory=torch.cuda.is_available())
+
+
+def _get_valid_batch_size(batch_size, n_negatives=10, valid_n_negatives=None, **kw):
+    """ mirror the _BertBPR defaults without building the model """
+    if valid_n_negatives is None:
+        valid_n_negatives = n_negatives
+    return batch_size * n_negatives * 2 // valid_n_negatives
 
 
 class BertBPR:
@@ -231,9 +291,10 @@ class BertBPR:
             self.item_titles.tolist(), padding='max_length', return_tensors='pt',
             max_length=self.max_length, truncation=True
         )
-        self.model = _BertBPR(self.all_inputs, **self._model_kw)
-        self.valid_batch_size = self.batch_size * self.model.n_negatives * 2 // self.model.valid_n_negatives
+        self._model = None  # created on first use; fit always trains a fresh one
+        self.valid_batch_size = _get_valid_batch_size(self.batch_size, **self._model_kw)
         self.predict_batch_size = 64 * torch.cuda.device_count()
+        self.cls_batch_size = 512 * max(1, torch.cuda.device_count())  # frozen bert, no activations kept
 
         self._ckpt_dirpath = []
         self._logger = TensorBoardLogger('logs', "BertBPR")
@@ -242,15 +303,32 @@ class BertBPR:
         ]})
         print(f'BertBPR logs at {self._logger.log_dir}')
 
+    def _create_model(self):
+        return _BertBPR(self.all_inputs, **self._model_kw)
+
+    def _is_trainable(self):
+        """ mirror the requires_grad flags of _create_bert and _Tower without building the model """
+        return not (self._model_kw['freeze_bert'] > 0 and not self._model_kw.get('elementwise_affine', True))
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self._create_model()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
+
     def _get_data_module(self, V):
         return _DataModule(V, self.item_titles.index, self.all_inputs, self.do_validation,
                            self.batch_size, self.valid_batch_size, self.predict_batch_size)
 
     @empty_cache_on_exit
     def fit(self, V=None, _lr_find=False):
-        if V is None or not any([param.requires_grad for param in self.model.parameters()]):
+        if V is None or not self._is_trainable():
             return self
-        model = _BertBPR(self.all_inputs, **self._model_kw)
+        model = self._create_model()
         dm = self._get_data_module(V)
         model.set_training_data(**dm.training_data)
         trainer = Trainer(
@@ -259,10 +337,7 @@ class BertBPR:
             log_every_n_steps=1, callbacks=[model._checkpoint, LearningRateMonitor()])
 
         if self._model_kw['freeze_bert'] > 0:  # cache all_cls
-            model.override_output_step = 'cls'
-            all_cls = trainer.predict(model, datamodule=dm)
-            model.register_buffer("all_cls", torch.cat(all_cls), False)
-            del model.override_output_step  # restore to final
+            self._precompute_cls(model, trainer, dm)
 
         if _lr_find:
             lr_finder = trainer.tuner.lr_find(model, datamodule=dm,
@@ -285,6 +360,16 @@ class BertBPR:
         self.model = model
         return self
 
+    def _precompute_cls(self, model, trainer, dm):
+        predict_batch_size, dm._predict_batch_size = dm._predict_batch_size, self.cls_batch_size
+        model.override_output_step = 'cls'
+        try:
+            all_cls = trainer.predict(model, datamodule=dm)
+        finally:  # restore even if the larger batches run out of memory
+            del model.override_output_step  # restore to final
+            dm._predict_batch_size = predict_batch_size
+        model.register_buffer("all_cls", torch.cat(all_cls), False)
+
     @empty_cache_on_exit
     @torch.no_grad()
     def transform(self, D):
@@ -297,6 +382,11 @@ class BertBPR:
         item_final = all_emb[dm.j_to_ptr]
         return auto_cast_lazy_score(user_final) @ item_final.T
 
-    def to_explainer(self, **kw):
-        tower = self.model.item_tower.to(auto_device()).eval()
-        return I2IExplainer(tower, self.tokenizer, **kw)
+    def to_quantized_inference(self):
+        """ int8 cpu copy of the item tower, e.g., to_explainer(tower=...) on cpu-only hosts """
+        return quantize_linear_int8(self.model.item_tower)
+
+    def to_explainer(self, tower=None, **kw):
+        if tower is None:
+            tower = self.model.item_tower.to(auto_device()).eval()
+        return I2IExplainer(tower, self.tokenizer, **{'max_length': self.max_length, **kw})
@@ -4,12 +4,13 @@ from ccrec.models.bbpr import (
     _Tower, _BertBPR, sps_to_torch, _device_mode_context, auto_device, BertBPR,
     AutoTokenizer, TensorBoardLogger, empty_cache_on_exit, _DataModule, Trainer,
     LightningDataModule, DataLoader, auto_cast_lazy_score, I2IExplainer,
-    default_random_split, _LitValidated)
+    default_random_split, _LitValidated, _get_valid_batch_size)
 from ccrec.models.vae_models import MaskedPretrainedModel, VAEPretrainedModel
 from transformers import DefaultDataCollator, DataCollatorForLanguageModeling
 from ccrec.models.vae_lightning import VAEData
 import rime
 from ccrec.env import create_zero_shot, parse_response
+from ccrec.util import auto_precision
 
 
 class _TowerMT(_Tower):
@@ -21,7 +22,7 @@ class _TowerMT(_Tower):
 
     def forward(self, cls=None, input_step='inputs', output_step='final', **inputs):
         if input_step == 'inputs':
-            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+            inputs = {k: v.to(self.model.device, non_blocking=True) for k, v in inputs.items()}
             if output_step == 'cls':
                 mean, std = self.model(**inputs, return_mean_std=True)
                 assert std == 0, "calling cls on vae model is ambiguous"
@@ -44,6 +45,7 @@ class _BertMT(_BertBPR):
                  replacement=True,
                  sample_with_prior=True, sample_with_posterior=0.5,
                  pretrained_checkpoint=None,
+                 compile_model=False,  # fuse kernels with torch.compile; in-place, keeps state_dict keys
                  ):
         super(_BertBPR, self).__init__()
         if valid_n_negatives is None:
@@ -62,6 +64,8 @@ class _BertMT(_BertBPR):
         vae_model = VAEPretrainedModel.from_pretrained(pretrained_checkpoint)
         if hasattr(vae_model, 'set_beta'):
             vae_model.set_beta(beta)
+        if compile_model:
+            vae_model.compile()
         self.item_tower = _TowerMT(vae_model)
 
         self.all_inputs = all_inputs
@@ -87,10 +91,11 @@ class _BertMT(_BertBPR):
 class _DataMT(_DataModule):
     def __init__(self, rime_dataset, item_df, tokenizer, all_inputs, do_validation=None,
                  batch_size=None, valid_batch_size=None, predict_batch_size=64 * torch.cuda.device_count(),
-                 **tokenizer_kw):
+                 cache_dir=None, **tokenizer_kw):
         super().__init__(rime_dataset, item_df.index, all_inputs, do_validation,
                          batch_size, valid_batch_size, predict_batch_size)
-        self._ct = VAEData(item_df, tokenizer, predict_batch_size, do_validation, **tokenizer_kw)
+        self._ct = VAEData(item_df, tokenizer, predict_batch_size, do_validation,
+                           cache_dir=cache_dir, **tokenizer_kw)
         self.training_data.update({
             'ct_cycles': max(1, self._num_batches / self._ct._num_batches),
             'ft_cycles': max(1, self._ct._num_batches / self._num_batches),
@@ -117,9 +122,13 @@ class BertMT(BertBPR):
                  model_name='distilbert-base-uncased', max_length=30,
                  max_epochs=10, max_steps=-1, do_validation=None,
                  strategy='dp', query_item_position_in_user_history=0,
+                 grad_accum=1,  # effective batch_size = batch_size * grad_accum
+                 cache_dir=None,  # reuse the ct tokenization across runs
                  **_model_kw):
         if do_validation is None:
             do_validation = max_epochs > 1
+        assert not (_model_kw.get('compile_model') and strategy == 'dp' and torch.cuda.device_count() > 1), \
+            "compiled models are not replicated by dp; please use ddp or a single gpu"
 
         self.item_titles = item_df['TITLE']
         self.max_length = max_length
@@ -128,39 +137,54 @@ class BertMT(BertBPR):
         self.max_epochs = max_epochs
         self.max_steps = max_steps
         self.strategy = strategy
+        self.grad_accum = grad_accum
+        self.cache_dir = cache_dir
         self._model_kw = {**_model_kw, 'model_name': model_name}
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         self.tokenizer_kw = dict(padding='max_length', max_length=self.max_length, truncation=True)
-        self.all_inputs = self.tokenizer(self.item_titles.tolist(), return_tensors='pt', **self.tokenizer_kw)
-
-        self.model = _BertMT(self.all_inputs, **self._model_kw)
-        self.valid_batch_size = self.batch_size * self.model.n_negatives * 2 // self.model.valid_n_negatives
+        all_inputs = self.tokenizer(self.item_titles.tolist(), return_tensors='pt', **self.tokenizer_kw)
+        self.all_inputs = {  # compact contiguous arrays, 5/16 of the int64 bytes to index and upload
+            'input_ids': all_inputs['input_ids'].to(torch.int32).contiguous(),
+            'attention_mask': all_inputs['attention_mask'].bool().contiguous(),
+        }
+
+        self._model = None  # created on first use; fit always trains a fresh one
+        self.valid_batch_size = _get_valid_batch_size(self.batch_size, **self._model_kw)
         self.predict_batch_size = 64 * torch.cuda.device_count()
 
         self._ckpt_dirpath = []
         self._logger = TensorBoardLogger('logs', "BertMT")
         self._logger.log_hyperparams({k: v for k, v in locals().items() if k in [
-            'batch_size', 'max_epochs', 'max_steps', 'sample_with_prior', 'sample_with_posterior'
+            'batch_size', 'max_epochs', 'max_steps', 'sample_with_prior', 'sample_with_posterior',
+            'grad_accum',
         ]})
         print(f'BertMT logs at {self._logger.log_dir}')
 
+    def _create_model(self):
+        return _BertMT(self.all_inputs, **self._model_kw)
+
+    def _is_trainable(self):
+        return True  # the vae model is never frozen
+
     def _get_data_module(self, V):
         return _DataMT(V, self.item_titles.to_frame(), self.tokenizer, self.all_inputs, self.do_validation,
-                       self.batch_size, self.valid_batch_size, self.predict_batch_size)
+                       self.batch_size, self.valid_batch_size, self.predict_batch_size,
+                       cache_dir=self.cache_dir)
 
     @empty_cache_on_exit
     def fit(self, V=None):
-        if V is None or not any([param.requires_grad for param in self.model.parameters()]):
+        if V is None or not self._is_trainable():
             return self
-        model = _BertMT(self.all_inputs, **self._model_kw)
+        model = self._create_model()
 
         dm = self._get_data_module(V)
         model.set_training_data(**dm.training_data)
         max_epochs = int(max(5, self.max_epochs / dm.training_data['ct_cycles']))
         trainer = Trainer(
             max_epochs=max_epochs, max_steps=self.max_steps,
-            gpus=torch.cuda.device_count(), strategy=self.strategy,
+            gpus=torch.cuda.device_count(), strategy=self.strategy, precision=auto_precision(),
+            accumulate_grad_batches=self.grad_accum,
             log_every_n_steps=1, callbacks=[model._checkpoint])
 
         trainer.fit(model, datamodule=dm)
@@ -178,7 +202,18 @@ class BertMT(BertBPR):
         return self
 
 
-def bmt_main(item_df, expl_response, gnd_response, max_epochs=50, alpha=0.05, beta=0.0):
+@torch.jit.script
+def _fused_prior(x: torch.Tensor) -> torch.Tensor:
+    return torch.log(torch.clamp_min(x + 1.0 / x.size(1), 0.0) + 1e-30)
+
+
+def _prior_fn(x):
+    """ log(max(0, x + 1 / n_items)) in one fused kernel; 1e-30 keeps fully-excluded rows finite.
+    Plain-function wrapper because scripted functions cannot be deep-copied with the model """
+    return _fused_prior(x)
+
+
+def bmt_main(item_df, expl_response, gnd_response, max_epochs=50, alpha=0.05, beta=0.0, cache_dir=None):
     """
     item_df = get_item_df()[0]
     expl_response = pd.read_json(
@@ -200,7 +235,7 @@ def bmt_main(item_df, expl_response, gnd_response, max_epochs=50, alpha=0.05, be
         max_epochs=50, batch_size=10 * torch.cuda.device_count(),
         sample_with_prior=True, sample_with_posterior=0,
         replacement=False, n_negatives=5, valid_n_negatives=5,
-        training_prior_fcn=lambda x: (x + 1 / x.shape[1]).clip(0, None).log(),
+        training_prior_fcn=_prior_fn, cache_dir=cache_dir,
     )
     bmt.fit(V)
 
@@ -1,4 +1,4 @@
-import torch, numpy as np, pandas as pd
+import torch, os, hashlib, numpy as np, pandas as pd
 from torch.utils.data import DataLoader
 from datasets import Dataset, DatasetDict
 from transformers import AutoTokenizer
@@ -6,9 +6,10 @@ from pytorch_lightning import LightningDataModule, Trainer
 from ccrec.models.vae_models import MaskedPretrainedModel, VAEPretrainedModel
 from transformers import DefaultDataCollator, DataCollatorForLanguageModeling
 import rime
-from rime.util import _LitValidated
+from rime.util import _LitValidated, auto_device
 from rime.models.zero_shot import ItemKNN
 from ccrec.env import create_zero_shot, parse_response
+from ccrec.util import auto_precision, bf16_autocast_enabled, quantize_linear_int8, _device_mode_context
 
 
 class VAETower(_LitValidated):
@@ -34,36 +35,60 @@ class VAETower(_LitValidated):
             self.parameters(), lr=2e-5, weight_decay=0.01)
 
 
+def _tokenize_titles(batch, tokenizer, **tokenizer_kw):
+    return tokenizer(batch['TITLE'], **tokenizer_kw)
+
+
+def _tokenize_item_df(item_df, tokenizer, cache_dir=None, **tokenizer_kw):
+    """ tokenize once; optionally reuse across processes from cache_dir, keyed by tokenizer and titles """
+    if cache_dir is not None:
+        key = hashlib.sha1(repr((
+            tokenizer.name_or_path, sorted(tokenizer_kw.items()), len(item_df),
+        )).encode() + '\0'.join(item_df['TITLE'].astype(str)).encode()).hexdigest()
+        path = os.path.join(cache_dir, f'vae-data-{key}')
+        if os.path.exists(path):
+            return Dataset.load_from_disk(path)
+
+    tokenized = Dataset.from_pandas(item_df.reset_index()[['TITLE']]).map(
+        _tokenize_titles, batched=True, batch_size=1024, remove_columns=['TITLE'],
+        fn_kwargs=dict(tokenizer=tokenizer, **tokenizer_kw))
+
+    if cache_dir is not None:
+        tokenized.save_to_disk(path)
+    return tokenized
+
+
 class VAEData(LightningDataModule):
     def __init__(self, item_df, tokenizer, batch_size=64, do_validation=True,
-                 truncation=True, padding='max_length', max_length=32, **kw):
+                 truncation=True, padding='max_length', max_length=32, cache_dir=None, **kw):
         super().__init__()
         self._item_df = item_df
         self._batch_size = batch_size
         self._do_validation = do_validation
-        self._tokenizer_fn = lambda x: tokenizer(
-            x['TITLE'], truncation=truncation, padding=padding, max_length=max_length, **kw)
         self._collate_fn = DefaultDataCollator()
         self._num_batches = len(item_df) / self._batch_size
+        self._tokenized = _tokenize_item_df(  # shared by all stages
+            item_df, tokenizer, cache_dir, truncation=truncation, padding=padding, max_length=max_length, **kw)
 
     def setup(self, stage):
-        _to_dataset = lambda x: Dataset.from_pandas(x.reset_index()[['TITLE']])
         if stage == 'fit':
             if self._do_validation and len(self._item_df) >= 5:
-                shuffled = self._item_df.sample(frac=1, random_state=1)
+                shuffled = pd.Series(np.arange(len(self._item_df))).sample(frac=1, random_state=1).values
                 self._ds = DatasetDict(
-                    train=_to_dataset(shuffled.iloc[:len(self._item_df) * 4 // 5]),
-                    valid=_to_dataset(shuffled.iloc[len(self._item_df) * 4 // 5:]))
+                    train=self._tokenized.select(shuffled[:len(self._item_df) * 4 // 5]),
+                    valid=self._tokenized.select(shuffled[len(self._item_df) * 4 // 5:]))
             else:
-                self._ds = DatasetDict(train=_to_dataset(self._item_df))
+                self._ds = DatasetDict(train=self._tokenized)
         else:  # predict
-            self._ds = DatasetDict(predict=_to_dataset(self._item_df))
-        self._ds = self._ds.map(self._tokenizer_fn, remove_columns=['TITLE'])
+            self._ds = DatasetDict(predict=self._tokenized)
 
     def _create_dataloader(self, split, shuffle=False):
         if split in self._ds:
+            num_workers = (len(self._ds[split]) > 1000) * min(4, os.cpu_count())
             return DataLoader(self._ds[split], batch_size=self._batch_size,
-                              collate_fn=self._collate_fn, shuffle=shuffle)
+                              collate_fn=self._collate_fn, shuffle=shuffle,
+                              num_workers=num_workers, persistent_workers=num_workers > 0,
+                              pin_memory=torch.cuda.is_available())
 
     def train_dataloader(self):
         return self._create_dataloader('train', True)
@@ -75,7 +100,26 @@ class VAEData(LightningDataModule):
         return self._create_dataloader('predict')
 
 
-def vae_main(item_df, gnd_response, max_epochs=50, beta=0, train_df=None):
+@torch.no_grad()
+def _predict_embedding(model, dm, num_items, device):
+    """ fill one preallocated buffer batch by batch, avoiding the peak memory of torch.cat """
+    dm.setup('predict')
+    out = None
+    i0 = 0
+    with _device_mode_context(model, device, training=False):
+        for batch in dm.predict_dataloader():
+            batch = {k: v.to(device, non_blocking=True) for k, v in batch.items()}
+            with torch.autocast('cuda', torch.bfloat16, enabled=bf16_autocast_enabled(device)):
+                emb = model(**batch, return_embedding=True)
+            if out is None:
+                out = torch.empty(num_items, emb.shape[1])
+            out[i0:i0 + len(emb)] = emb
+            i0 += len(emb)
+    return out
+
+
+def vae_main(item_df, gnd_response, max_epochs=50, beta=0, train_df=None, quantized_inference=False,
+             cache_dir=None):
     """
     item_df = get_item_df()[0]  # indexed by ITEM_ID
     gnd_response = pd.read_json(
@@ -85,17 +129,19 @@ def vae_main(item_df, gnd_response, max_epochs=50, beta=0, train_df=None):
     if train_df is None:
         train_df = item_df
 
-    tokenizer = AutoTokenizer.from_pretrained('distilbert-base-uncased')
+    tokenizer = AutoTokenizer.from_pretrained('distilbert-base-uncased', use_fast=True)
     tower = VAETower(beta)
-    train_dm = VAEData(train_df, tokenizer, 64 * max(1, torch.cuda.device_count()))
+    train_dm = VAEData(train_df, tokenizer, 64 * max(1, torch.cuda.device_count()), cache_dir=cache_dir)
     trainer = Trainer(max_epochs=max_epochs, gpus=torch.cuda.device_count(),
                       strategy='dp' if torch.cuda.device_count() else None,
-                      log_every_n_steps=1)
+                      precision=auto_precision(), log_every_n_steps=1)
     trainer.fit(tower, datamodule=train_dm)
 
-    test_dm = VAEData(item_df, tokenizer, 64 * max(1, torch.cuda.device_count()))
-    item_emb = trainer.predict(tower, datamodule=test_dm)
-    item_emb = torch.cat(item_emb)
+    test_dm = VAEData(item_df, tokenizer, 64 * max(1, torch.cuda.device_count()), cache_dir=cache_dir)
+    if quantized_inference:  # int8 linear layers on cpu
+        item_emb = _predict_embedding(quantize_linear_int8(tower.model), test_dm, len(item_df), torch.device('cpu'))
+    else:
+        item_emb = _predict_embedding(tower.model, test_dm, len(item_df), auto_device())
     varCT = ItemKNN(item_df.assign(embedding=item_emb.tolist(), _hist_len=1))
 
     # evaluation
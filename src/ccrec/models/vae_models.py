@@ -32,11 +32,18 @@ class EmbeddingModel(DistilBertPreTrainedModel):
     def generate_mean(self,hidden_states):
         raise NotImplementedError("return type: torch.Tensor")
     
-    def generate_std(self,hidden_states):
+    def generate_log_var(self,hidden_states):
         raise NotImplementedError("return type: float or torch.Tensor")
     
-    def compute_output_loss(self, mu, std, prediction_logits, input_ids,labels):
+    def compute_output_loss(self, mu, log_var, prediction_logits, input_ids,labels):
         raise NotImplementedError("return type: torch.Tensor")
+
+    def shared_logits_cross_entropy(self, prediction_logits, target):
+        """ same as self.loss_fct over prediction_logits (bs, vocab_size) repeated at every position of
+        target (bs, seq_length), without materializing the repeated logits """
+        valid = target != self.loss_fct.ignore_index
+        logp = prediction_logits.log_softmax(-1).gather(1, target.masked_fill(~valid, 0))  # (bs, seq_length)
+        return -(logp * valid).sum() / valid.sum()
     
     def forward(
         self,
@@ -52,29 +59,30 @@ class EmbeddingModel(DistilBertPreTrainedModel):
         return_dict: Optional[bool] = None
     ) -> Union[MaskedLMOutput, Tuple[torch.Tensor, ...]]:
 
-        return_dict = return_dict if return_dict is not None else self.config.use_return_dict
-
         dlbrt_output = self.distilbert(
             input_ids=input_ids,
             attention_mask=attention_mask,
             head_mask=head_mask,
             inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
+            output_attentions=False,  # only the cls state is used; do not stash per-layer activations
+            output_hidden_states=False,
+            return_dict=True,
         )
         
-        seq_length = dlbrt_output[0].size(dim = 1)
-        hidden_states = dlbrt_output[0][:,0,:]  # (bs, dim)
+        hidden_states = dlbrt_output.last_hidden_state.select(1, 0)  # (bs, dim)
 
         mu = self.generate_mean(hidden_states)
-        std = self.generate_std(hidden_states)
+        log_var = self.generate_log_var(hidden_states)
+        std = math.exp(0.5 * log_var) if isinstance(log_var, float) else torch.exp(0.5 * log_var)
 
         if return_mean_std:
             return mu, std
 
-        eps = torch.randn_like(mu)
-        hidden_states = eps * std + mu
+        if isinstance(std, float) and std == 0.0:  # MaskedPretrainedModel; no noise to sample
+            hidden_states = mu
+        else:
+            eps = torch.randn_like(mu)
+            hidden_states = eps * std + mu
         
         hidden_states = self.vocab_transform(hidden_states)  # (bs, dim)
         hidden_states = self.activation(hidden_states)  # (bs, dim)
@@ -84,37 +92,34 @@ class EmbeddingModel(DistilBertPreTrainedModel):
             return self.standard_layer_norm(hidden_states) 
         
         prediction_logits = self.vocab_layer_norm(hidden_states)  # (bs, dim)
-        prediction_logits = self.vocab_projector(prediction_logits)  # (bs, vocab_size)
-        
-        bs = prediction_logits.size(dim = 0)
-        vocab_size = prediction_logits.size(dim = 1)
-        
-        prediction_logits = torch.reshape(prediction_logits,(bs,1,vocab_size))
-        prediction_logits = prediction_logits.repeat(1,seq_length,1)
+        prediction_logits = self.vocab_projector(prediction_logits).float()  # (bs, vocab_size), same at every position
 
-        output_loss = self.compute_output_loss(mu, std, prediction_logits, input_ids, labels)
+        # keep the cross-entropy and kld in fp32 under mixed precision
+        with torch.autocast(prediction_logits.device.type, enabled=False):
+            output_loss = self.compute_output_loss(
+                mu.float(), log_var if isinstance(log_var, float) else log_var.float(),
+                prediction_logits, input_ids, labels)
 
+        seq_length = (input_ids if input_ids is not None else inputs_embeds).shape[1]
         return MaskedLMOutput(
             loss=output_loss,
-            logits=prediction_logits,
-            hidden_states=dlbrt_output.hidden_states,
-            attentions=dlbrt_output.attentions,
+            logits=prediction_logits.unsqueeze(1).expand(-1, seq_length, -1),  # zero-copy (bs, seq_length, vocab_size)
         )
 
 
 class MaskedPretrainedModel(EmbeddingModel):
     def __init__(self, config: PretrainedConfig):
         super().__init__(config)
-        self.std = 0.0
+        self.log_var = -math.inf  # std = 0
 
     def generate_mean(self,hidden_states):
         return hidden_states
     
-    def generate_std(self,hidden_states):
-        return self.std
+    def generate_log_var(self,hidden_states):
+        return self.log_var
     
-    def compute_output_loss(self, mu, std, prediction_logits, input_ids, labels):
-        return self.loss_fct(prediction_logits.view(-1, prediction_logits.size(-1)), labels.view(-1)) 
+    def compute_output_loss(self, mu, log_var, prediction_logits, input_ids, labels):
+        return self.shared_logits_cross_entropy(prediction_logits, labels)
     
 
 class VAEPretrainedModel(EmbeddingModel):
@@ -128,15 +133,15 @@ class VAEPretrainedModel(EmbeddingModel):
     def VAE_post_init(self):
         dim = self.fc_var.weight.size(1)
 
-        #intialize fc_mu to be identity
-        self.fc_mu.bias.data.zero_()
-        self.fc_mu.weight.data = torch.eye(dim)
+        #intialize fc_mu to be identity, in place to keep the parameter device and dtype
+        nn.init.zeros_(self.fc_mu.bias)
+        nn.init.eye_(self.fc_mu.weight)
 
         #initialize fc_var according to prior
         var_init = 0.01
         stdv = var_init / math.sqrt(dim)
-        self.fc_var.weight.data.uniform_(-stdv, stdv)
-        self.fc_var.bias.data.zero_()
+        nn.init.uniform_(self.fc_var.weight, -stdv, stdv)
+        nn.init.zeros_(self.fc_var.bias)
     
     def set_beta(self, beta):
         self.vae_beta = beta
@@ -144,13 +149,12 @@ class VAEPretrainedModel(EmbeddingModel):
     def generate_mean(self,hidden_states):
         return self.fc_mu(hidden_states)
     
-    def generate_std(self,hidden_states):
-        log_var = self.fc_var(hidden_states)
-        return torch.exp(0.5 * log_var)
+    def generate_log_var(self,hidden_states):
+        return self.fc_var(hidden_states)
     
-    def compute_output_loss(self, mu, std, prediction_logits, input_ids, labels):
+    def compute_output_loss(self, mu, log_var, prediction_logits, input_ids, labels):
 
-        recon_loss = self.loss_fct(prediction_logits.view(-1, prediction_logits.size(-1)), input_ids.view(-1))
-        kld_loss = torch.mean(-0.5 * torch.sum(1 + 2 * torch.log(std) - mu ** 2 - std ** 2, dim = 1), dim = 0)
+        recon_loss = self.shared_logits_cross_entropy(prediction_logits, input_ids)
+        kld_loss = -0.5 * (1 + log_var - mu.pow(2) - log_var.exp()).sum(1).mean()
 
         return recon_loss + self.vae_beta * kld_loss
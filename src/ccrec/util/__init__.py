@@ -1,4 +1,4 @@
-import collections, contextlib
+import collections, contextlib, copy, torch
 import numpy as np
 
 
@@ -23,6 +23,59 @@ def merge_unique(list_of_lists, num_per_list, total, rng=np.random):
     return list(unique.keys()), list(unique.values())
 
 
+def merge_unique_batch(lists, num_per_list, total, rng=np.random):
+    """ merge_unique for all rows at once; lists[i] is an (n_rows, len_i) array of candidates.
+    Loops over merge positions instead of rows; returns (n_rows, total) items and group ids. """
+    lists = [np.asarray(a) for a in lists]
+    for a in lists:
+        assert a.shape[1] >= total, f"please provide enough inputs to avoid short returns {a.shape}"
+    n_rows = len(lists[0])
+    rows = np.arange(n_rows)
+    padded = np.stack([np.pad(a, [(0, 0), (0, max(b.shape[1] for b in lists) - a.shape[1])], 'edge')
+                       for a in lists], 1)  # (n_rows, n_lists, max_len)
+
+    labels = np.hstack([[i] * a.shape[1] for i, a in enumerate(lists)])
+    random_groups = labels[np.argsort(rng.random((n_rows, len(labels))), axis=1)]
+    num_per_list = np.asarray(num_per_list)
+
+    queue_ptr = np.zeros((n_rows, len(lists)), dtype=int)
+    c = np.zeros((n_rows, len(lists)), dtype=int)
+    nunique = np.zeros(n_rows, dtype=int)
+    unique = np.zeros((n_rows, total), dtype=padded.dtype)
+    groups = np.full((n_rows, total), -1)
+    for i in random_groups.T:
+        x = padded[rows, i, queue_ptr[rows, i]]
+        queue_ptr[rows, i] += 1
+        seen = (unique == x[:, None]) & (np.arange(total) < nunique[:, None])
+        valid = (c[rows, i] < num_per_list[i]) & (nunique < total)
+        assert not (valid & (seen & (groups == i[:, None])).any(1)).any(), "duplication detected in list"
+        accept = np.flatnonzero(valid & ~seen.any(1))
+        unique[accept, nunique[accept]] = x[accept]
+        groups[accept, nunique[accept]] = i[accept]
+        c[accept, i[accept]] += 1
+        nunique[accept] += 1
+
+    assert (nunique == total).all(), "short returns detected; please provide more unique inputs"
+    return unique, groups
+
+
+def bf16_autocast_enabled(device):
+    return device.type == 'cuda' and torch.cuda.is_bf16_supported()
+
+
+def auto_precision():
+    """ Trainer precision: bf16 where supported, fp16 with grad scaling on older gpus, else fp32 """
+    if not torch.cuda.is_available():
+        return 32
+    return 'bf16' if torch.cuda.is_bf16_supported() else 16
+
+
+def quantize_linear_int8(module):
+    """ int8 dynamic-quantized copy of the Linear layers for cpu inference; module is left intact """
+    return torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(module).cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
 @contextlib.contextmanager
 def _device_mode_context(module, device, training):
     old_device = getattr(module, "device", 'cpu')
@@ -1,7 +1,9 @@
 import matplotlib.pyplot as plt
 from matplotlib import transforms
+from matplotlib.textpath import TextToPath
 import dataclasses, typing, torch
 import shap
+from ccrec.util import bf16_autocast_enabled
 from shap.plots._text import unpack_shap_explanation_contents, process_shap_values, colors
 
 
@@ -36,7 +38,8 @@ def rainbow_text(x, y, ls, lc, width=40, nrows=4, **kw):
 
     t = plt.gca().transData
     fig = plt.gcf()
-    # plt.show()
+    text_to_path = TextToPath()  # measures widths in points without a renderer round-trip per token
+    line_height = None  # one renderer measurement per call; includes descent and line spacing
     cur_words = 0
     cur_x = 0
     cur_rows = 0
@@ -47,17 +50,19 @@ def rainbow_text(x, y, ls, lc, width=40, nrows=4, **kw):
         if not isinstance(c, str):
             color = colors.red_transparent_blue(c)
             text.set_bbox(dict(facecolor=color, edgecolor='none', pad=0, boxstyle='round'))
-        text.draw(fig.canvas.get_renderer())
-        ex = text.get_window_extent()
+        if line_height is None:
+            line_height = text.get_window_extent(fig.canvas.get_renderer()).height * 72 / fig.dpi
+        ex_width, _, _ = text_to_path.get_text_width_height_descent(
+            s, text.get_fontproperties(), ismath=False)
         if cur_words + len(s) >= width:
-            t = transforms.offset_copy(text._transform, x=-cur_x, y=-ex.height * 1.2, units='dots')
+            t = transforms.offset_copy(text._transform, fig=fig, x=-cur_x, y=-line_height * 1.2, units='points')
             cur_words = 0
             cur_x = 0
             cur_rows += 1
         else:
-            t = transforms.offset_copy(text._transform, x=ex.width, units='dots')
+            t = transforms.offset_copy(text._transform, fig=fig, x=ex_width, units='points')
             cur_words += len(s)
-            cur_x += ex.width
+            cur_x += ex_width
         if cur_rows >= nrows:
             break
 
@@ -74,22 +79,26 @@ class I2IExplainer:
     tokenizer: typing.Any
     fixed_context: int = 0  # 0 yields sparser results
     max_length: int = 128
+    batch_size: int = 256  # perturbations per forward; shap's "auto" uses much smaller batches
 
     @property
     def tokenizer_kw(self):
         return dict(padding=True, return_tensors='pt', max_length=self.max_length, truncation=True)
 
+    def _embed(self, texts):
+        device = getattr(self.item_tower, 'device', torch.device('cpu'))
+        _inputs = self.tokenizer(texts, **self.tokenizer_kw)
+        with torch.autocast('cuda', torch.bfloat16, enabled=bf16_autocast_enabled(device)):
+            return self.item_tower(**_inputs).float()
+
     @torch.no_grad()
     def __call__(self, given, cand_texts):
-        _inputs = self.tokenizer(given, **self.tokenizer_kw)
-        x = self.item_tower(**_inputs)
-        x = x.mean(0, keepdims=True)
+        x = self._embed(given).mean(0, keepdims=True)
 
         @torch.no_grad()
         def f(cand_texts):
-            _inputs = self.tokenizer(cand_texts.tolist(), **self.tokenizer_kw)
-            y = self.item_tower(**_inputs)
+            y = self._embed(cand_texts.tolist())
             return (x * y).sum(-1).cpu().numpy()
 
         explainer = shap.Explainer(f, self.tokenizer)
-        return explainer(cand_texts, fixed_context=self.fixed_context)
+        return explainer(cand_texts, fixed_context=self.fixed_context, batch_size=self.batch_size)
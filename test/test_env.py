@@ -0,0 +1,74 @@
+import numpy as np, pandas as pd
+import pytest
+from ccrec.env.base import _evaluate_response, _sort_or_shuffle, parse_response
+
+
+def create_response(n_users=20, n_cands=4, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'USER_ID': np.arange(n_users),
+        'TEST_START_TIME': 1,
+        '_hist_items': [[u] for u in range(n_users)],
+        'cand_items': [rng.choice(100, n_cands, replace=False).tolist() for _ in range(n_users)],
+        '_group': [rng.randint(-1, 3, n_cands).tolist() for _ in range(n_users)],
+        'multi_label': [rng.randint(0, 2, n_cands).tolist() for _ in range(n_users)],
+        'request_time': rng.randint(0, 3, n_users) + 1e3,
+    }).set_index(['USER_ID', 'TEST_START_TIME']).assign(
+        cand_titles=lambda df: df['cand_items'].apply(lambda x: [f'title {y}' for y in x]))
+
+
+def test_evaluate_response():
+    response = create_response()
+    data = np.vstack(response['multi_label'])
+    group = np.vstack(response['_group'])
+
+    expect = {str(g): data[group == g].sum() / (group == g).sum() for g in np.unique(group)}
+    assert _evaluate_response(data, group) == expect
+
+
+def test_sort_candidates():
+    response = create_response()
+    response['_group'] = response['_group'].apply(lambda x: [max(g, 0) for g in x])
+    out = _sort_or_shuffle(response, True)
+
+    for col in ['_group', 'cand_items', 'cand_titles']:  # baseline: stable argsort per row
+        expect = response.apply(lambda x: np.asarray(x[col])[
+            np.argsort(x['_group'], kind='stable')].tolist(), axis=1)
+        assert out[col].tolist() == expect.tolist()
+
+
+def test_sort_or_shuffle_invalid_and_alignment():
+    response = create_response()
+    out = _sort_or_shuffle(response, True)
+    for g in out['_group']:
+        valid = [x for x in g if x != -1]
+        assert g == sorted(valid) + [-1] * (len(g) - len(valid))
+
+    out = _sort_or_shuffle(response, False)
+    for (_, old), (_, new) in zip(response.iterrows(), out.iterrows()):
+        old_rows = sorted(zip(old['cand_items'], old['cand_titles'], old['_group']))
+        new_rows = sorted(zip(new['cand_items'], new['cand_titles'], new['_group']))
+        assert old_rows == new_rows
+
+
+def _parse_response_baseline(response, step_idx=None):
+    if step_idx is None:
+        step_idx = response['request_time'].rank(method='dense').values - 1
+    response = response.assign(step_idx=step_idx).set_index("step_idx", append=True)
+
+    new_events = response['cand_items'].explode().to_frame("ITEM_ID")
+    new_events['USER_ID'] = new_events.index.get_level_values(0)
+    new_events['TIMESTAMP'] = response['request_time']
+    new_events['VALUE'] = response['multi_label'].explode().values
+    new_events['_group'] = response['_group'].explode().values
+    new_events['step_idx'] = new_events.index.get_level_values(-1)
+    return new_events.reset_index(drop=True)
+
+
+@pytest.mark.parametrize('step_idx', [None, 3])
+def test_parse_response(step_idx):
+    response = create_response()
+    pd.testing.assert_frame_equal(
+        parse_response(response, step_idx),
+        _parse_response_baseline(response, step_idx).infer_objects(),
+        check_dtype=False)
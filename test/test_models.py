@@ -0,0 +1,47 @@
+import torch
+from transformers import DistilBertConfig
+from ccrec.models.bbpr import _sample_from_cdf
+from ccrec.models.vae_models import MaskedPretrainedModel, VAEPretrainedModel
+
+
+def test_sample_from_cdf(num_samples=20000):
+    torch.manual_seed(0)
+    probs = torch.rand(3, 6) * torch.tensor([1, 0, 1, 1, 0, 1])  # unnormalized, like softmax outputs
+    samples = _sample_from_cdf(probs.cumsum(-1), num_samples)
+    assert samples.shape == (3, num_samples)
+
+    freq = torch.stack([torch.bincount(s, minlength=6) for s in samples]).float() / num_samples
+    expect = probs / probs.sum(-1, keepdim=True)  # torch.multinomial(probs, replacement=True)
+    assert (freq[expect == 0] == 0).all()
+    assert torch.allclose(freq, expect, atol=0.02)
+
+
+def create_tiny_model(model_cls):
+    config = DistilBertConfig(vocab_size=50, dim=16, n_layers=1, n_heads=2, hidden_dim=32)
+    return model_cls(config)
+
+
+def test_shared_logits_cross_entropy(bs=4, seq_length=7, vocab_size=50):
+    torch.manual_seed(0)
+    model = create_tiny_model(MaskedPretrainedModel)
+    logits = torch.randn(bs, vocab_size)
+    target = torch.randint(vocab_size, (bs, seq_length))
+    target[0, :3] = -100  # partially ignored row
+    target[1] = -100  # fully ignored row
+
+    expect = model.loss_fct(logits[:, None].repeat(1, seq_length, 1).view(-1, vocab_size), target.view(-1))
+    torch.testing.assert_close(model.shared_logits_cross_entropy(logits, target), expect)
+
+
+def test_vae_kld_from_log_var(bs=4, seq_length=7, vocab_size=50, dim=16, beta=0.1):
+    torch.manual_seed(0)
+    model = create_tiny_model(VAEPretrainedModel)
+    model.set_beta(beta)
+    mu, log_var = torch.randn(bs, dim), torch.randn(bs, dim)
+    logits = torch.randn(bs, vocab_size)
+    input_ids = torch.randint(vocab_size, (bs, seq_length))
+
+    std = torch.exp(0.5 * log_var)  # baseline: kld from std
+    kld = torch.mean(-0.5 * torch.sum(1 + 2 * torch.log(std) - mu ** 2 - std ** 2, dim=1), dim=0)
+    expect = model.shared_logits_cross_entropy(logits, input_ids) + beta * kld
+    torch.testing.assert_close(model.compute_output_loss(mu, log_var, logits, input_ids, None), expect)
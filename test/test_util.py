@@ -0,0 +1,64 @@
+import numpy as np, matplotlib.pyplot as plt
+import pytest
+from ccrec.util import merge_unique, merge_unique_batch
+from ccrec.util.shap_explainer import rainbow_text
+
+
+class _FixedOrder:
+    """ replay the same random merge order to merge_unique and merge_unique_batch """
+    def __init__(self, keys):
+        self.keys = keys
+
+    def random(self, shape):
+        assert shape == self.keys.shape
+        return self.keys
+
+    def permutation(self, x):
+        return np.asarray(x)[np.argsort(self.keys)]
+
+
+@pytest.mark.parametrize('num_per_list', [[2, 2], [3, 1], [1, 2, 1]])
+def test_merge_unique_batch(num_per_list, n_rows=50, list_len=6, pool=8):
+    rng = np.random.RandomState(0)
+    total = sum(num_per_list)
+    lists = [np.array([rng.choice(pool, list_len, replace=False) for _ in range(n_rows)])
+             for _ in num_per_list]  # unique within each list; overlapping across lists
+    keys = rng.random_sample((n_rows, list_len * len(lists)))
+
+    unique, groups = merge_unique_batch(lists, num_per_list, total, _FixedOrder(keys))
+    assert unique.shape == groups.shape == (n_rows, total)
+
+    for r in range(n_rows):
+        expect = merge_unique([a[r] for a in lists], num_per_list, total, _FixedOrder(keys[r]))
+        assert unique[r].tolist() == expect[0]
+        assert groups[r].tolist() == expect[1]
+
+        assert len(set(unique[r])) == total
+        assert np.bincount(groups[r], minlength=len(lists)).tolist() == num_per_list
+        for x, g in zip(unique[r], groups[r]):
+            assert x in lists[g][r]
+
+
+def test_merge_unique_batch_assertions():
+    with pytest.raises(AssertionError, match='duplication detected'):
+        merge_unique_batch([[[1, 1, 2, 3]], [[4, 5, 6, 7]]], [2, 2], 4)
+
+    with pytest.raises(AssertionError, match='short returns'):
+        merge_unique_batch([[[1, 2, 3]], [[4, 5, 6, 7]]], [2, 2], 4)
+
+
+def test_rainbow_text(width=20, nrows=2):
+    plt.switch_backend('Agg')
+    fig = plt.figure()
+    plt.axis('off')
+    tokens = ['word '] * 12
+    rainbow_text(0, 0.5, tokens, ['black'] + [0.8] * 11, width=width, nrows=nrows, fontsize=12)
+    fig.canvas.draw()
+
+    ex = [t.get_window_extent() for t in fig.gca().texts]
+    per_row = width // len(tokens[0])  # the token that reaches the width ends the row
+    assert len(ex) == per_row * nrows
+    assert abs(ex[1].x0 - ex[0].x1) < 2  # tokens abut within a row
+    assert abs(ex[per_row].x0 - ex[0].x0) < 2  # next row restarts at x
+    assert abs(ex[0].y0 - ex[per_row].y0 - 1.2 * ex[0].height) < 1  # same spacing as the window extent
+    plt.close(fig)